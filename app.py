@@ -1,5 +1,13 @@
 import os 
 import re
+import io
+import hashlib
+import time
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 from flask import Flask, request, render_template
 import requests
 from requests.auth import HTTPBasicAuth
@@ -7,6 +15,7 @@ from sentence_transformers import SentenceTransformer
 import ollama
 import chromadb
 from chromadb.config import Settings
+import extractors
 
 
 #Setting up the Confluence ENV Variables conifguration for authentication
@@ -16,6 +25,28 @@ CONFLUENCE_EMAIL = os.getenv('CONFLUENCE_EMAIL', '').strip()
 VERIFY_SSL = os.getenv('VERIFY_SSL', 'false').lower() == 'true'  # Default to false for corporate environments
 CHROMADB_HOST = os.getenv('CHROMADB_HOST', 'chromadb-service:8000')  # External ChromaDB service
 OLLAMA_HOST = os.getenv('OLLAMA_HOST', 'ollama-service:11434')  # Default to Kubernetes service
+OLLAMA_TIMEOUT = int(os.getenv('OLLAMA_TIMEOUT', '300'))  # Seconds a single Ollama call may hold a query slot
+
+# Admission control for the question endpoint
+MAX_INFLIGHT_QUERIES = int(os.getenv('MAX_INFLIGHT_QUERIES', '2'))  # Queries allowed to run at the same time
+MAX_QUEUED_QUERIES = int(os.getenv('MAX_QUEUED_QUERIES', '4'))  # Queries allowed to wait for a free slot
+QUERY_QUEUE_TIMEOUT = float(os.getenv('QUERY_QUEUE_TIMEOUT', '10'))  # Seconds a queued query waits before 503
+RETRY_AFTER_SECONDS = int(os.getenv('RETRY_AFTER_SECONDS', '15'))  # Retry-After hint sent with 429/503
+INGEST_RETRY_COOLDOWN = int(os.getenv('INGEST_RETRY_COOLDOWN', '600'))  # Seconds before retrying an ingest that stored nothing
+
+# Attachment ingestion - text is extracted in a process pool, files over the per-type limit are skipped
+ATTACHMENT_EXTRACT_WORKERS = int(os.getenv('ATTACHMENT_EXTRACT_WORKERS', '2'))
+ATTACHMENT_EXTRACT_TIMEOUT = int(os.getenv('ATTACHMENT_EXTRACT_TIMEOUT', '120'))  # Seconds one file may take to parse
+ATTACHMENT_SIZE_LIMITS = {
+    "pdf": int(os.getenv('MAX_PDF_BYTES', str(20 * 1024 * 1024))),
+    "docx": int(os.getenv('MAX_DOCX_BYTES', str(10 * 1024 * 1024))),
+    "xlsx": int(os.getenv('MAX_XLSX_BYTES', str(10 * 1024 * 1024)))
+}
+ATTACHMENT_MEDIA_TYPES = {
+    "application/pdf": "pdf",
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document": "docx",
+    "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet": "xlsx"
+}
 
 app = Flask(__name__)
 
@@ -24,7 +55,7 @@ app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 0
 app.config['PERMANENT_SESSION_LIFETIME'] = 300  # 5 minutes
 
 # Initialize Ollama client with configurable host and timeout
-ollama_client = ollama.Client(host=f'http://{OLLAMA_HOST}', timeout=300)  # 5 minute timeout
+ollama_client = ollama.Client(host=f'http://{OLLAMA_HOST}', timeout=OLLAMA_TIMEOUT)  # 5 minute timeout by default
 
 # Initialize ChromaDB HTTP client to connect to external service
 try:
@@ -48,15 +79,18 @@ except Exception as e:
     print("Using embedded ChromaDB client")
 
 collection = db.get_or_create_collection("confluence")
+# Attachments that yield no text (e.g. scanned PDFs) are recorded here with their version and content hash,
+# so unchanged ones are skipped on refresh. Kept apart so these markers never show up in question results
+empty_attachments = db.get_or_create_collection("confluence_empty_attachments")
 
 # Fetching all confluence page on startup with pagination loop till fetching all pages
 
-def get_space_page_count():
-    """Get the total number of pages in the space"""
+def get_space_page_count(content_type="page"):
+    """Get the total number of pages (or blogposts) in the space"""
     space_key = os.getenv('CONFLUENCE_SPACE_KEY', '').strip()
-    print(f"get_space_page_count: Getting total count for space '{space_key}'")
+    print(f"get_space_page_count: Getting total {content_type} count for space '{space_key}'")
     
-    url = f"{CONFLUENCE_BASE_URL}/rest/api/content?type=page&limit=1"
+    url = f"{CONFLUENCE_BASE_URL}/rest/api/content?type={content_type}&limit=1"
     if space_key:
         url += f"&spaceKey={space_key}"
     
@@ -73,20 +107,20 @@ def get_space_page_count():
     resp.raise_for_status()
     data = resp.json()
     total_pages = data.get("size", 0)
-    print(f"get_space_page_count: Total pages in space: {total_pages}")
+    print(f"get_space_page_count: Total {content_type}s in space: {total_pages}")
     return total_pages
 
-def fetch_all_page_ids():
-    """Fetch all page IDs from the space using pagination"""
+def fetch_all_page_ids(content_type="page"):
+    """Fetch all page (or blogpost) IDs from the space using pagination"""
     space_key = os.getenv('CONFLUENCE_SPACE_KEY', '').strip()
-    print(f"fetch_all_page_ids: Starting with space_key='{space_key}'")
+    print(f"fetch_all_page_ids: Starting with space_key='{space_key}', type='{content_type}'")
     
     page_ids = []
     start = 0
     limit = 500  # Maximum limit to minimize API calls
     
     while True:
-        url = f"{CONFLUENCE_BASE_URL}/rest/api/content?type=page&limit={limit}&start={start}"
+        url = f"{CONFLUENCE_BASE_URL}/rest/api/content?type={content_type}&limit={limit}&start={start}"
         if space_key:
             url += f"&spaceKey={space_key}"
         
@@ -121,10 +155,10 @@ def fetch_all_page_ids():
     return page_ids
 
 def fetch_page_content_by_id(page_id):
-    """Fetch individual page content with body.storage"""
+    """Fetch individual page or blogpost content with body.storage and its comments"""
     print(f"fetch_page_content_by_id: Fetching content for page ID: {page_id}")
     
-    url = f"{CONFLUENCE_BASE_URL}/rest/api/content/{page_id}?expand=body.storage"
+    url = f"{CONFLUENCE_BASE_URL}/rest/api/content/{page_id}?expand=body.storage,children.comment.body.storage"
     
     resp = requests.get(
         url,
@@ -139,21 +173,62 @@ def fetch_page_content_by_id(page_id):
     resp.raise_for_status()
     page_data = resp.json()
     
+    # The expand only returns the first batch of root-level comments, without replies. A page with no root
+    # comment has no replies either, otherwise fetch the whole thread tree with pagination
+    comments = page_data.get("children", {}).get("comment", {})
+    if comments.get("results"):
+        comments["results"] = fetch_page_comments(page_id)
+        print(f"fetch_page_content_by_id: Fetched {len(comments['results'])} comments including replies")
+    
     print(f"fetch_page_content_by_id: Successfully fetched '{page_data.get('title', 'Unknown title')}'")
     return page_data
 
-def fetch_all_pages():
-    """Main function to fetch all pages using the robust strategy"""
-    print("fetch_all_pages: Starting robust page fetching strategy...")
+def fetch_page_comments(page_id):
+    """Fetch all comments of a page or blogpost, replies included, with body.storage using pagination"""
+    comments = []
+    start = 0
+    limit = 100
+    
+    while True:
+        url = f"{CONFLUENCE_BASE_URL}/rest/api/content/{page_id}/child/comment?expand=body.storage&depth=all&limit={limit}&start={start}"
+        
+        print(f"fetch_page_comments: Fetching comments batch for page ID {page_id} (start={start}, limit={limit})")
+        resp = requests.get(
+            url,
+            headers={
+                "Accept": "application/json",
+                "Authorization": f"Bearer {CONFLUENCE_API_TOKEN}"
+            },
+            verify=VERIFY_SSL,
+            timeout=30
+        )
+        
+        resp.raise_for_status()
+        data = resp.json()
+        
+        current_batch = data.get("results", [])
+        comments.extend(current_batch)
+        
+        # The server may cap the limit, so follow the next link instead of comparing sizes
+        if not current_batch or "next" not in data.get("_links", {}):
+            break
+            
+        start += len(current_batch)
+    
+    return comments
+
+def fetch_all_pages(content_type="page"):
+    """Main function to fetch all pages (or blogposts) using the robust strategy"""
+    print(f"fetch_all_pages: Starting robust {content_type} fetching strategy...")
     
     # Step 1: Get total page count
-    total_count = get_space_page_count()
+    total_count = get_space_page_count(content_type)
     if total_count == 0:
-        print("fetch_all_pages: No pages found in space")
+        print(f"fetch_all_pages: No {content_type}s found in space")
         return []
     
     # Step 2: Fetch all page IDs
-    page_ids = fetch_all_page_ids()
+    page_ids = fetch_all_page_ids(content_type)
     if len(page_ids) != total_count:
         print(f"fetch_all_pages: WARNING - Expected {total_count} pages but got {len(page_ids)} IDs")
     
@@ -182,6 +257,78 @@ def fetch_all_pages():
     
     return pages
 
+def fetch_all_attachments():
+    """Fetch attachment metadata for the space using CQL search with pagination"""
+    space_key = os.getenv('CONFLUENCE_SPACE_KEY', '').strip()
+    print(f"fetch_all_attachments: Starting with space_key='{space_key}'")
+    
+    cql = "type=attachment"
+    if space_key:
+        cql += f' and space="{space_key}"'
+    
+    attachments = []
+    start = 0
+    limit = 100
+    
+    while True:
+        print(f"fetch_all_attachments: Fetching batch (start={start}, limit={limit})")
+        resp = requests.get(
+            f"{CONFLUENCE_BASE_URL}/rest/api/content/search",
+            params={"cql": cql, "start": start, "limit": limit, "expand": "container,version"},
+            headers={
+                "Accept": "application/json",
+                "Authorization": f"Bearer {CONFLUENCE_API_TOKEN}"
+            },
+            verify=VERIFY_SSL,
+            timeout=30
+        )
+        
+        resp.raise_for_status()
+        data = resp.json()
+        
+        current_batch = data.get("results", [])
+        attachments.extend(current_batch)
+        print(f"fetch_all_attachments: Got {len(current_batch)} attachments in this batch (total so far: {len(attachments)})")
+        
+        # Search may cap the limit server side, so follow the next link instead of comparing sizes
+        if not current_batch or "next" not in data.get("_links", {}):
+            break
+            
+        start += len(current_batch)
+    
+    print(f"fetch_all_attachments: FINISHED - Total attachments collected: {len(attachments)}")
+    return attachments
+
+def get_attachment_file_type(attachment):
+    """Map an attachment to pdf/docx/xlsx by media type or file extension, None if unsupported"""
+    media_type = attachment.get("extensions", {}).get("mediaType", "")
+    if media_type in ATTACHMENT_MEDIA_TYPES:
+        return ATTACHMENT_MEDIA_TYPES[media_type]
+    
+    extension = os.path.splitext(attachment.get("title", ""))[1].lower().lstrip(".")
+    return extension if extension in ATTACHMENT_SIZE_LIMITS else None
+
+def download_attachment(download_path, max_bytes):
+    """Stream an attachment download, returns None when it grows past max_bytes"""
+    url = f"{CONFLUENCE_BASE_URL}{download_path}"
+    
+    with requests.get(
+        url,
+        headers={"Authorization": f"Bearer {CONFLUENCE_API_TOKEN}"},
+        verify=VERIFY_SSL,
+        timeout=60,
+        stream=True
+    ) as resp:
+        resp.raise_for_status()
+        
+        buffer = io.BytesIO()
+        for block in resp.iter_content(chunk_size=64 * 1024):
+            if buffer.tell() + len(block) > max_bytes:
+                return None
+            buffer.write(block)
+        
+        return buffer.getvalue()
+
 # Function to chunk text into smaller parts for processing
 def chunk_text(text, chunk_size=500):
     words = text.split()
@@ -190,6 +337,332 @@ def chunk_text(text, chunk_size=500):
         for i in range(0, len(words), chunk_size)
     ]
 
+def content_hash(content):
+    """SHA-256 of page text or attachment bytes, stored with each chunk to skip unchanged content"""
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+    return hashlib.sha256(content).hexdigest()
+
+def get_stored_metadata(source_id):
+    """Metadata of one stored chunk for source_id (content_hash, version, ...), empty dict if none is stored"""
+    existing = collection.get(where={"source_id": source_id}, limit=1, include=["metadatas"])
+    metadatas = existing.get("metadatas") or []
+    return metadatas[0] if metadatas and metadatas[0] else {}
+
+def get_stored_attachment_metadata(source_id):
+    """Like get_stored_metadata, falling back to the empty attachment marker"""
+    stored = get_stored_metadata(source_id)
+    if stored:
+        return stored
+    
+    marker = empty_attachments.get(ids=[source_id], include=["metadatas"])
+    return marker["metadatas"][0] if marker["ids"] and marker["metadatas"][0] else {}
+
+def update_stored_version(source_id, version):
+    """Record a new attachment version on chunks (or the empty marker) whose content turned out unchanged"""
+    for target in (collection, empty_attachments):
+        existing = target.get(where={"source_id": source_id}, include=["metadatas"])
+        if existing["ids"]:
+            target.update(
+                ids=existing["ids"],
+                metadatas=[dict(metadata, version=version) for metadata in existing["metadatas"]]
+            )
+
+def record_empty_attachment(source_id, title, digest, version):
+    """Store an empty attachment marker and drop chunks from an older version that still had text"""
+    metadata = {
+        "title": title,
+        "type": "attachment",
+        "source_id": source_id,
+        "content_hash": digest
+    }
+    if version is not None:
+        metadata["version"] = version
+    
+    try:
+        collection.delete(where={"source_id": source_id})
+        # The marker collection is never queried, a one-dimensional placeholder embedding is enough
+        empty_attachments.upsert(ids=[source_id], embeddings=[[0.0]], metadatas=[metadata])
+    except Exception as marker_error:
+        print(f"  ERROR recording empty attachment '{title}': {str(marker_error)}")
+
+def remove_legacy_chunks():
+    """Delete chunks stored before source_id/content_hash metadata existed, re-ingest never replaces them"""
+    legacy_ids = []
+    offset = 0
+    limit = 1000
+    
+    while True:
+        batch = collection.get(include=["metadatas"], limit=limit, offset=offset)
+        for chunk_id, metadata in zip(batch["ids"], batch["metadatas"]):
+            if not metadata or "source_id" not in metadata:
+                legacy_ids.append(chunk_id)
+        
+        if len(batch["ids"]) < limit:
+            break
+            
+        offset += limit
+    
+    if legacy_ids:
+        print(f"remove_legacy_chunks: Deleting {len(legacy_ids)} chunks without source_id metadata")
+        for i in range(0, len(legacy_ids), limit):
+            collection.delete(ids=legacy_ids[i:i+limit])
+    
+    return len(legacy_ids)
+
+def store_document(model, source_id, title, text, content_type, digest, version=None):
+    """Chunk, embed and store one document, replacing any older chunks for it. Returns chunks stored"""
+    chunks = [chunk for chunk in chunk_text(text) if len(chunk.strip()) > 0]
+    print(f"  Generated {len(chunks)} chunks")
+    
+    chunk_ids = [f"{source_id}_{chunk_idx}" for chunk_idx in range(len(chunks))]
+    metadata = {
+        "title": title,
+        "type": content_type,
+        "source_id": source_id,
+        "content_hash": digest
+    }
+    if version is not None:
+        metadata["version"] = version
+    
+    try:
+        # Embed every chunk before writing, so a failure leaves the previous version untouched
+        # (its older content_hash no longer matches, so the next run retries this document)
+        print(f"    Embedding {len(chunks)} chunks for {content_type} '{title}'")
+        embeddings = model.encode(chunks)
+        
+        # Convert NumPy array to Python list for ChromaDB
+        embeddings_list = embeddings.tolist()
+    except Exception as embed_error:
+        print(f"    ERROR embedding {content_type} '{title}': {str(embed_error)}")
+        return 0
+    
+    try:
+        print(f"    Adding {len(chunks)} chunks with IDs {source_id}_0..{source_id}_{len(chunks) - 1}")
+        collection.upsert(
+            documents=chunks,
+            metadatas=[dict(metadata) for _ in chunks],
+            embeddings=embeddings_list,
+            ids=chunk_ids
+        )
+    except Exception as store_error:
+        print(f"    ERROR storing {content_type} '{title}': {str(store_error)}")
+        # The upsert may have been partially applied, drop the document so the next run retries it
+        try:
+            collection.delete(where={"source_id": source_id})
+        except Exception as delete_error:
+            print(f"    ERROR removing partially stored {content_type} '{title}': {str(delete_error)}")
+        return 0
+    
+    try:
+        # Drop chunks left over from a previous, longer version of the document
+        current_ids = set(chunk_ids)
+        existing = collection.get(where={"source_id": source_id}, include=[])
+        stale_ids = [chunk_id for chunk_id in existing["ids"] if chunk_id not in current_ids]
+        if stale_ids:
+            print(f"    Removing {len(stale_ids)} stale chunks")
+            collection.delete(ids=stale_ids)
+    except Exception as cleanup_error:
+        print(f"    ERROR removing stale chunks for {content_type} '{title}': {str(cleanup_error)}")
+        return 0
+    
+    return len(chunks)
+
+def get_attachment_title(attachment):
+    """Attachment file name prefixed with the title of the page it is attached to"""
+    title = attachment.get("title", "Untitled")
+    container_title = attachment.get("container", {}).get("title")
+    if container_title:
+        title = f"{container_title} / {title}"
+    return title
+
+def store_extracted_attachment(model, text, job):
+    """Store the text extracted for an attachment job. Returns chunks stored"""
+    attachment = job["attachment"]
+    title = get_attachment_title(attachment)
+    
+    print(f"Processing attachment: {title}")
+    print(f"  Extracted text length: {len(text)} characters")
+    if len(text.strip()) == 0:
+        print(f"  WARNING: Attachment '{title}' has no text content after extraction, recording it as empty")
+        record_empty_attachment(attachment["id"], title, job["digest"], job["version"])
+        return 0
+    
+    stored = store_document(model, attachment["id"], title, text, "attachment", job["digest"], job["version"])
+    if stored:
+        try:
+            # An older version may have been empty
+            if empty_attachments.get(ids=[attachment["id"]], include=[])["ids"]:
+                empty_attachments.delete(ids=[attachment["id"]])
+        except Exception as marker_error:
+            print(f"  ERROR removing empty attachment marker for '{title}': {str(marker_error)}")
+    return stored
+
+def create_extraction_pool():
+    """Process pool for attachment text extraction"""
+    # forkserver instead of fork: this process serves requests on several threads and has torch loaded.
+    # The server only preloads extractors, so workers never hold the model or the ChromaDB client
+    mp_context = multiprocessing.get_context("forkserver")
+    mp_context.set_forkserver_preload(["extractors"])
+    return ProcessPoolExecutor(max_workers=ATTACHMENT_EXTRACT_WORKERS, mp_context=mp_context)
+
+def kill_extraction_pool(pool):
+    """Kill the pool's worker processes and shut it down without waiting on a hung or crashed extraction"""
+    for process in list((pool._processes or {}).values()):
+        process.kill()
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def submit_extraction(pool, pending, job):
+    """Submit an attachment job to the pool, returns the pool to keep using (a new one if it was broken)"""
+    try:
+        future = pool.submit(extractors.extract_attachment_text, job["file_type"], job["data"])
+    except BrokenProcessPool:
+        print("submit_extraction: Extraction pool is broken, recreating it")
+        kill_extraction_pool(pool)
+        pool = create_extraction_pool()
+        future = pool.submit(extractors.extract_attachment_text, job["file_type"], job["data"])
+    
+    job["submitted_at"] = time.monotonic()
+    pending[future] = job
+    return pool
+
+def collect_extractions(model, pool, pending, wait_for_all):
+    """Store finished extractions until fewer jobs than workers are pending (or none if wait_for_all).
+    Hung files are skipped after ATTACHMENT_EXTRACT_TIMEOUT and files in a crashed pool are retried once, alone.
+    Returns the pool to keep using and the chunks stored"""
+    chunk_count = 0
+    
+    while pending and (wait_for_all or len(pending) >= ATTACHMENT_EXTRACT_WORKERS):
+        # Pending jobs never outnumber workers, so each one started running when it was submitted
+        oldest = min(job["submitted_at"] for job in pending.values())
+        timeout = max(0, oldest + ATTACHMENT_EXTRACT_TIMEOUT - time.monotonic())
+        done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+        
+        if not done:
+            now = time.monotonic()
+            for future, job in list(pending.items()):
+                if now - job["submitted_at"] >= ATTACHMENT_EXTRACT_TIMEOUT:
+                    del pending[future]
+                    print(f"  ERROR extracting {job['file_type']} attachment '{get_attachment_title(job['attachment'])}': no result within {ATTACHMENT_EXTRACT_TIMEOUT}s, skipping")
+            
+            # A hung worker can only be stopped by killing the pool, the other jobs start over in a new one
+            retry_jobs = list(pending.values())
+            pending.clear()
+            kill_extraction_pool(pool)
+            pool = create_extraction_pool()
+            for job in retry_jobs:
+                pool = submit_extraction(pool, pending, job)
+            continue
+        
+        crashed_jobs = []
+        for future in done:
+            job = pending.pop(future)
+            try:
+                text = future.result()
+            except BrokenProcessPool:
+                crashed_jobs.append(job)
+                continue
+            except Exception as extract_error:
+                print(f"  ERROR extracting {job['file_type']} attachment '{get_attachment_title(job['attachment'])}': {str(extract_error)}")
+                continue
+            
+            chunk_count += store_extracted_attachment(model, text, job)
+        
+        if crashed_jobs:
+            # A worker died (e.g. out of memory), which fails every job still in that pool without telling
+            # which file caused it. Retry them one at a time in a new pool, so only a file that crashes it
+            # again on its own is skipped
+            crashed_jobs.extend(pending.values())
+            pending.clear()
+            kill_extraction_pool(pool)
+            pool = create_extraction_pool()
+            for job in crashed_jobs:
+                if job["attempts"] >= 2:
+                    print(f"  ERROR extracting {job['file_type']} attachment '{get_attachment_title(job['attachment'])}': extraction process crashed, skipping")
+                    continue
+                job["attempts"] += 1
+                pool = submit_extraction(pool, pending, job)
+                pool, stored_chunks = collect_extractions(model, pool, pending, wait_for_all=True)
+                chunk_count += stored_chunks
+    
+    return pool, chunk_count
+
+def embed_and_store_attachments(model):
+    """Download supported attachments and extract their text in a process pool while fetching continues"""
+    attachments = fetch_all_attachments()
+    print(f"Fetched {len(attachments)} attachments metadata from Confluence.")
+    
+    chunk_count = 0
+    skipped = 0
+    pending = {}
+    pool = create_extraction_pool()
+    
+    try:
+        for i, attachment in enumerate(attachments, 1):
+            title = attachment.get("title", "Untitled")
+            file_type = get_attachment_file_type(attachment)
+            if file_type is None:
+                skipped += 1
+                continue
+            
+            max_bytes = ATTACHMENT_SIZE_LIMITS[file_type]
+            if attachment.get("extensions", {}).get("fileSize", 0) > max_bytes:
+                print(f"  Skipping attachment '{title}': larger than {max_bytes} bytes {file_type} limit")
+                skipped += 1
+                continue
+            
+            # Skip on the Confluence version first, so unchanged attachments are not downloaded at all
+            version = attachment.get("version", {}).get("number")
+            stored = get_stored_attachment_metadata(attachment["id"])
+            if version is not None and stored.get("version") == version:
+                print(f"  Attachment '{title}' version {version} already ingested, skipping")
+                skipped += 1
+                continue
+            
+            try:
+                print(f"Downloading attachment {i}/{len(attachments)}: {title}")
+                data = download_attachment(attachment.get("_links", {}).get("download", ""), max_bytes)
+            except Exception as download_error:
+                print(f"  ERROR downloading attachment '{title}': {str(download_error)}")
+                continue
+            
+            if data is None:
+                print(f"  Skipping attachment '{title}': download exceeded {max_bytes} bytes {file_type} limit")
+                skipped += 1
+                continue
+            
+            # A new version can carry the same bytes, the hash still saves the extraction and embedding
+            digest = content_hash(data)
+            if stored.get("content_hash") == digest:
+                print(f"  Attachment '{title}' unchanged since last ingest, skipping")
+                if version is not None:
+                    update_stored_version(attachment["id"], version)
+                skipped += 1
+                continue
+            
+            job = {
+                "attachment": attachment,
+                "file_type": file_type,
+                "digest": digest,
+                "version": version,
+                "data": data,
+                "attempts": 1
+            }
+            pool = submit_extraction(pool, pending, job)
+            
+            # Bound downloaded bytes held in memory, and keep one job per worker so timeouts start at submit
+            pool, stored_chunks = collect_extractions(model, pool, pending, wait_for_all=False)
+            chunk_count += stored_chunks
+        
+        pool, stored_chunks = collect_extractions(model, pool, pending, wait_for_all=True)
+        chunk_count += stored_chunks
+    finally:
+        # Never wait on workers here, a hung one would block the ingest (and ingest_lock) forever
+        kill_extraction_pool(pool)
+    
+    print(f"SUCCESS: Stored {chunk_count} attachment chunks in ChromaDB ({skipped} attachments skipped)")
+    return chunk_count
+
 def embed_and_store_pages():
     print("Starting to fetch and embed Confluence pages...")
     try:
@@ -198,20 +671,24 @@ def embed_and_store_pages():
         print("Model loaded successfully.")
         
         print("Calling fetch_all_pages()...")
-        pages = fetch_all_pages()
-        print(f"Fetched {len(pages)} pages from Confluence.")
+        pages = fetch_all_pages() + fetch_all_pages("blogpost")
+        print(f"Fetched {len(pages)} pages and blogposts from Confluence.")
         
         if len(pages) == 0:
             print("WARNING: No pages fetched from Confluence!")
-            return
         
         # Check ChromaDB connection
         print(f"ChromaDB collection count before processing: {collection.count()}")
         
+        # Chunks from older versions of this app carry only a title, they would otherwise stay as stale duplicates
+        remove_legacy_chunks()
+        
         chunk_count = 0
+        unchanged_pages = 0
         for i, page in enumerate(pages):
             print(f"Processing page {i+1}/{len(pages)}: {page.get('title', 'Untitled')}")
             title = page.get("title", "")
+            content_type = page.get("type", "page")
             
             # Check if page has body content
             if "body" not in page or "storage" not in page["body"]:
@@ -221,6 +698,13 @@ def embed_and_store_pages():
             content = page["body"]["storage"]["value"]
             print(f"  Raw content length: {len(content)} characters")
             
+            # Comments are indexed together with the page they belong to
+            comments = page.get("children", {}).get("comment", {}).get("results", [])
+            for comment in comments:
+                content += "\n" + comment.get("body", {}).get("storage", {}).get("value", "")
+            if comments:
+                print(f"  Appended {len(comments)} comments")
+            
             clean_content = re.sub(r'<[^>]+>', '', content)
             print(f"  Clean content length: {len(clean_content)} characters")
             
@@ -228,49 +712,25 @@ def embed_and_store_pages():
                 print(f"  WARNING: Page '{title}' has no text content after cleaning")
                 continue
             
-            chunks = chunk_text(clean_content)
-            print(f"  Generated {len(chunks)} chunks")
+            source_id = page.get('id', 'unknown')
+            digest = content_hash(clean_content)
+            if get_stored_metadata(source_id).get("content_hash") == digest:
+                print(f"  Page '{title}' unchanged since last ingest, skipping")
+                unchanged_pages += 1
+                continue
             
-            for chunk_idx, chunk in enumerate(chunks):
-                if len(chunk.strip()) == 0:
-                    continue
-                    
-                try:
-                    print(f"    Embedding chunk {chunk_idx+1}/{len(chunks)} for page '{title}'")
-                    embeddings = model.encode(chunk)
-                    
-                    # Convert NumPy array to Python list for ChromaDB
-                    embeddings_list = embeddings.tolist()
-                    
-                    # Try to add to collection with detailed error handling
-                    chunk_id = f"{page.get('id', 'unknown')}_{chunk_count}"
-                    print(f"    Adding chunk with ID: {chunk_id}")
-                    
-                    collection.add(
-                        documents=[chunk],
-                        metadatas=[{"title": title}],
-                        embeddings=[embeddings_list],
-                        ids=[chunk_id]
-                    )
-                    chunk_count += 1
-                    print(f"    Successfully added chunk {chunk_count}")
-                    
-                    # Check collection count every 10 chunks
-                    if chunk_count % 10 == 0:
-                        current_count = collection.count()
-                        print(f"    ChromaDB collection count: {current_count}")
-                        
-                except Exception as chunk_error:
-                    print(f"    ERROR adding chunk {chunk_idx} for page '{title}': {str(chunk_error)}")
-                    continue
+            chunk_count += store_document(model, source_id, title, clean_content, content_type, digest)
             
             # Progress update every 10 pages
             if i % 10 == 0:
                 current_count = collection.count()
                 print(f"  Progress - {i}/{len(pages)} pages processed, ChromaDB count: {current_count}")
 
+        print(f"SUCCESS: Stored {len(pages) - unchanged_pages} pages with {chunk_count} chunks in ChromaDB ({unchanged_pages} unchanged)")
+        
+        chunk_count += embed_and_store_attachments(model)
+        
         final_count = collection.count()
-        print(f"SUCCESS: Stored {len(pages)} pages with {chunk_count} chunks in ChromaDB")
         print(f"Final ChromaDB collection count: {final_count}")
         
         if final_count == 0:
@@ -287,15 +747,110 @@ def embed_and_store_pages():
 # Initialize the sentence transformer model first
 model = SentenceTransformer('all-MiniLM-L6-v2')
 
-# Check if the collection is empty, if so, populate it on first request
-# This is done lazily to avoid blocking app startup
-def ensure_data_loaded():
-    """Ensure data is loaded into ChromaDB, called lazily on first request"""
-    if collection.count() == 0:
-        print("ChromaDB is empty, fetching and embedding Confluence pages...")
+# Check if the collection is empty, if so, populate it in the background on first request
+# This is done lazily to avoid blocking app startup, and the lock keeps a single ingest running at a time
+ingest_lock = threading.Lock()
+data_available = False  # Set once ChromaDB has been seen with chunks, so later requests skip count()
+last_ingest = {"finished_at": None, "chunks": None}
+
+def run_ingest():
+    """Run embed_and_store_pages and record its result, releasing ingest_lock which the caller must have acquired"""
+    try:
         embed_and_store_pages()
-    else:
-        print(f"ChromaDB already contains {collection.count()} chunks")
+    finally:
+        try:
+            chunks = collection.count()
+        except Exception as e:
+            print(f"run_ingest: Could not count ChromaDB chunks after ingest: {str(e)}")
+            chunks = 0
+        last_ingest["finished_at"] = time.monotonic()
+        last_ingest["chunks"] = chunks
+        print(f"run_ingest: Ingest finished with {chunks} chunks in ChromaDB")
+        ingest_lock.release()
+
+def ensure_data_loaded():
+    """Check ChromaDB has data, starting a background ingest if needed.
+    Returns ("ready", None), ("loading", retry_after) or ("failed", retry_after)"""
+    global data_available
+    if data_available:
+        return "ready", None
+    
+    if collection.count() > 0:
+        data_available = True
+        return "ready", None
+    
+    if ingest_lock.locked():
+        return "loading", RETRY_AFTER_SECONDS
+    
+    # The last ingest stored nothing (bad credentials, empty space, ChromaDB errors), wait before retrying it
+    finished_at = last_ingest["finished_at"]
+    if finished_at is not None:
+        retry_in = INGEST_RETRY_COOLDOWN - (time.monotonic() - finished_at)
+        if retry_in > 0:
+            return "failed", int(retry_in) + 1
+    
+    if ingest_lock.acquire(blocking=False):
+        print("ChromaDB is empty, fetching and embedding Confluence pages in the background...")
+        threading.Thread(target=run_ingest, daemon=True).start()
+    return "loading", RETRY_AFTER_SECONDS
+
+# Admission control - bound how many questions run against Ollama at once and how many may wait,
+# so a burst of POSTs is shed with 429/503 instead of tying up every worker thread.
+# Waiters are admitted strictly in arrival order: a new request only takes a free slot when nobody is queued.
+admission_condition = threading.Condition()
+waiting_queue = deque()
+admission_stats = {
+    "in_flight": 0,
+    "queued": 0,
+    "admitted": 0,
+    "rejected_queue_full": 0,
+    "rejected_queue_timeout": 0
+}
+
+def acquire_query_slot():
+    """Try to admit a query, returns None when admitted or the HTTP status to reject with"""
+    with admission_condition:
+        if admission_stats["in_flight"] < MAX_INFLIGHT_QUERIES and not waiting_queue:
+            admission_stats["in_flight"] += 1
+            admission_stats["admitted"] += 1
+            return None
+        
+        if len(waiting_queue) >= MAX_QUEUED_QUERIES:
+            admission_stats["rejected_queue_full"] += 1
+            print(f"acquire_query_slot: Queue full ({len(waiting_queue)} waiting), rejecting with 429")
+            return 429
+        
+        ticket = object()
+        waiting_queue.append(ticket)
+        admission_stats["queued"] = len(waiting_queue)
+        deadline = time.monotonic() + QUERY_QUEUE_TIMEOUT
+        
+        # wait() releases the condition, so other requests can still be admitted or rejected quickly
+        while waiting_queue[0] is not ticket or admission_stats["in_flight"] >= MAX_INFLIGHT_QUERIES:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                waiting_queue.remove(ticket)
+                admission_stats["queued"] = len(waiting_queue)
+                admission_stats["rejected_queue_timeout"] += 1
+                # The head of the queue may have changed, let the new head re-check
+                admission_condition.notify_all()
+                print(f"acquire_query_slot: No slot freed within {QUERY_QUEUE_TIMEOUT}s, rejecting with 503")
+                return 503
+            admission_condition.wait(remaining)
+        
+        waiting_queue.popleft()
+        admission_stats["queued"] = len(waiting_queue)
+        admission_stats["in_flight"] += 1
+        admission_stats["admitted"] += 1
+        # More than one slot may be free, let the next waiter re-check
+        admission_condition.notify_all()
+        return None
+
+def release_query_slot():
+    """Release a slot taken by acquire_query_slot and hand it to the head of the queue"""
+    with admission_condition:
+        admission_stats["in_flight"] -= 1
+        admission_condition.notify_all()
 
 # Flask Routing 
 @app.route("/", methods=["GET", "POST"])
@@ -305,42 +860,70 @@ def index():
     if request.method == "POST":
         question = request.form.get("question", "")
         if question:
+            # Check for data before taking a slot, so slots only cover embed + query + Ollama
             try:
-                # Ensure data is loaded before processing queries
-                ensure_data_loaded()
-                
-                # Debug: Check ChromaDB status
-                total_chunks = collection.count()
-                print(f"DEBUG: ChromaDB contains {total_chunks} chunks")
-                
-                if total_chunks == 0:
-                    answer = "No Confluence data found in database. Please check your Confluence configuration and restart the application."
-                    return render_template("index.html", answer=answer, question=question)
-                
-                # Perform vector search (reduced to 2 results for speed)
-                q_emb = model.encode([question])
-                # Convert NumPy array to Python list for ChromaDB
-                q_emb_list = q_emb.tolist()
-                results = collection.query(query_embeddings=q_emb_list, n_results=2)
-                
-                # Debug: Check query results (disabled for speed)
-                # print(f"DEBUG: Query returned {len(results['documents'][0]) if results['documents'] else 0} results")
-                # if results['documents'] and len(results['documents'][0]) > 0:
-                #     for i, doc in enumerate(results['documents'][0]):
-                #         print(f"DEBUG: Result {i+1} preview: {doc[:200]}...")
-                
-                relevant_chunks = [doc for docs in results['documents'] for doc in docs]
-                
-                if not relevant_chunks:
-                    answer = "No relevant information found in the Confluence data for your question."
-                    return render_template("index.html", answer=answer, question=question)
-                
-                context = "\n".join(relevant_chunks)[:1500]  # Reduced for faster processing
-                # print(f"DEBUG: Context length: {len(context)}")
-                # print(f"DEBUG: Context preview: {context[:300]}...")
-                
-                # Enhanced prompt for better accuracy and conciseness
-                prompt = f"""You are a helpful assistant that answers questions based on Confluence documentation. 
+                data_state, retry_after = ensure_data_loaded()
+            except Exception as e:
+                answer = f"Sorry, I couldn't process your question. Error: {str(e)}"
+                print(f"DEBUG: Exception: {str(e)}")
+                return render_template("index.html", answer=answer, question=question), 503, {"Retry-After": str(RETRY_AFTER_SECONDS)}
+            
+            if data_state == "loading":
+                answer = "Confluence data is still being loaded into the database. Please try again in a few minutes, or check /debug if this persists."
+                return render_template("index.html", answer=answer, question=question), 503, {"Retry-After": str(retry_after)}
+            
+            if data_state == "failed":
+                answer = f"No Confluence data found in database. Please check your Confluence configuration (see /debug). Loading is retried automatically in {retry_after} seconds, or now via /refresh."
+                return render_template("index.html", answer=answer, question=question), 503, {"Retry-After": str(retry_after)}
+            
+            rejection_status = acquire_query_slot()
+            if rejection_status is not None:
+                answer = "The bot is busy answering other questions right now. Please try again in a few seconds."
+                return render_template("index.html", answer=answer, question=question), rejection_status, {"Retry-After": str(RETRY_AFTER_SECONDS)}
+            
+            try:
+                return answer_question(question)
+            finally:
+                release_query_slot()
+    
+    return render_template("index.html", answer=answer, question=question)
+
+def answer_question(question):
+    """Run vector search and Ollama for an admitted question and render the answer"""
+    answer = ""
+    try:
+        # Debug: Check ChromaDB status
+        total_chunks = collection.count()
+        print(f"DEBUG: ChromaDB contains {total_chunks} chunks")
+        
+        if total_chunks == 0:
+            answer = "No Confluence data found in database. Please check your Confluence configuration and restart the application."
+            return render_template("index.html", answer=answer, question=question)
+        
+        # Perform vector search (reduced to 2 results for speed)
+        q_emb = model.encode([question])
+        # Convert NumPy array to Python list for ChromaDB
+        q_emb_list = q_emb.tolist()
+        results = collection.query(query_embeddings=q_emb_list, n_results=2)
+        
+        # Debug: Check query results (disabled for speed)
+        # print(f"DEBUG: Query returned {len(results['documents'][0]) if results['documents'] else 0} results")
+        # if results['documents'] and len(results['documents'][0]) > 0:
+        #     for i, doc in enumerate(results['documents'][0]):
+        #         print(f"DEBUG: Result {i+1} preview: {doc[:200]}...")
+        
+        relevant_chunks = [doc for docs in results['documents'] for doc in docs]
+        
+        if not relevant_chunks:
+            answer = "No relevant information found in the Confluence data for your question."
+            return render_template("index.html", answer=answer, question=question)
+        
+        context = "\n".join(relevant_chunks)[:1500]  # Reduced for faster processing
+        # print(f"DEBUG: Context length: {len(context)}")
+        # print(f"DEBUG: Context preview: {context[:300]}...")
+        
+        # Enhanced prompt for better accuracy and conciseness
+        prompt = f"""You are a helpful assistant that answers questions based on Confluence documentation. 
 
 DOCUMENTATION:
 {context}
@@ -354,25 +937,25 @@ Instructions:
 - Keep your answer under 100 words
 
 ANSWER:"""
-                
-                # Try the model we actually downloaded
-                try:
-                    response = ollama_client.chat(
-                        model='llama3.2:1b', 
-                        messages=[{'role': 'user', 'content': prompt}],
-                        options={'temperature': 0.1, 'num_predict': 150, 'top_p': 0.9, 'stop': ['\n\nQUESTION:', '\n\nCONFLUENCE DOCUMENTATION:']}
-                    )
-                except Exception as ollama_error:
-                    # If specific error, provide more details
-                    answer = f"Sorry, I couldn't process your question. Ollama error: {str(ollama_error)}"
-                    return render_template("index.html", answer=answer, question=question)
-                
-                answer = response['message']['content']
-                # print(f"DEBUG: Model response: {answer}")  # Disabled for speed
-                
-            except Exception as e:
-                answer = f"Sorry, I couldn't process your question. Error: {str(e)}"
-                print(f"DEBUG: Exception: {str(e)}")
+        
+        # Try the model we actually downloaded
+        try:
+            response = ollama_client.chat(
+                model='llama3.2:1b', 
+                messages=[{'role': 'user', 'content': prompt}],
+                options={'temperature': 0.1, 'num_predict': 150, 'top_p': 0.9, 'stop': ['\n\nQUESTION:', '\n\nCONFLUENCE DOCUMENTATION:']}
+            )
+        except Exception as ollama_error:
+            # If specific error, provide more details
+            answer = f"Sorry, I couldn't process your question. Ollama error: {str(ollama_error)}"
+            return render_template("index.html", answer=answer, question=question)
+        
+        answer = response['message']['content']
+        # print(f"DEBUG: Model response: {answer}")  # Disabled for speed
+        
+    except Exception as e:
+        answer = f"Sorry, I couldn't process your question. Error: {str(e)}"
+        print(f"DEBUG: Exception: {str(e)}")
     
     return render_template("index.html", answer=answer, question=question)
 
@@ -432,9 +1015,12 @@ def debug_info():
 @app.route("/refresh")
 def refresh_data():
     """Manually refresh Confluence data"""
+    if not ingest_lock.acquire(blocking=False):
+        return "A data refresh is already running. Please try again once it has finished."
     try:
-        embed_and_store_pages()
-        return f"Data refresh completed. ChromaDB now contains {collection.count()} chunks."
+        # run_ingest records the result and releases ingest_lock
+        run_ingest()
+        return f"Data refresh completed. ChromaDB now contains {last_ingest['chunks']} chunks."
     except Exception as e:
         return f"Data refresh failed: {str(e)}"
     
@@ -500,6 +1086,16 @@ def health_check():
     """Simple health check endpoint that doesn't count chunks for faster response"""
     return {"status": "healthy"}, 200
 
+@app.route("/metrics")
+def metrics():
+    """Admission control counters, served without taking a query slot"""
+    with admission_condition:
+        stats = dict(admission_stats)
+    stats["max_inflight"] = MAX_INFLIGHT_QUERIES
+    stats["max_queued"] = MAX_QUEUED_QUERIES
+    stats["queue_timeout_seconds"] = QUERY_QUEUE_TIMEOUT
+    return stats, 200
+
 @app.route("/spaces")
 def list_spaces():
     """List all available spaces"""
@@ -689,5 +1285,7 @@ def documentation():
                              total_pages=369)
 
 
+# Local development only - the container runs "python -m flask --app app run" so attachment
+# extraction workers do not re-import this script (and load the model) as __mp_main__
 if __name__ == "__main__":
     app.run(debug=True, host='0.0.0.0', port=5300)
@@ -0,0 +1,34 @@
+import io
+import docx
+from openpyxl import load_workbook
+from pypdf import PdfReader
+
+# Attachment text extraction, kept out of app.py so the extraction process pool only imports
+# these parsers and never the Flask app, the SentenceTransformer model or the ChromaDB client
+
+def extract_attachment_text(file_type, data):
+    """Extract plain text from attachment bytes, runs inside the extraction process pool"""
+    if file_type == "pdf":
+        reader = PdfReader(io.BytesIO(data))
+        return "\n".join(page.extract_text() or "" for page in reader.pages)
+    
+    if file_type == "docx":
+        document = docx.Document(io.BytesIO(data))
+        lines = [paragraph.text for paragraph in document.paragraphs]
+        for table in document.tables:
+            for row in table.rows:
+                lines.append(" ".join(cell.text for cell in row.cells))
+        return "\n".join(lines)
+    
+    if file_type == "xlsx":
+        workbook = load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+        lines = []
+        for sheet in workbook.worksheets:
+            for row in sheet.iter_rows(values_only=True):
+                values = [str(value) for value in row if value is not None]
+                if values:
+                    lines.append(" ".join(values))
+        workbook.close()
+        return "\n".join(lines)
+    
+    return ""